@@ -3,22 +3,29 @@ import csv
 import shutil
 import logging
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
-import re
+from utils import copy_file, sanitize_filename, ensure_dir, forget_dirs, DEFAULT_IO_WORKERS
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def sanitize_filename(filename):
-    # 替换无效字符为下划线
-    sanitized_name = re.sub(r'[<>:"/\\|?*]', '_', filename)
-    # 去除前后的空格和点号
-    sanitized_name = sanitized_name.strip(' .')
-    # 限制文件名长度
-    sanitized_name = sanitized_name[:255]
-    return sanitized_name
+def link_or_copy(src, dst):
+    # 优先创建硬链接, 不复制任何数据; 跨设备或文件系统不支持时退回复制
+    try:
+        os.link(src, dst)
+    except (FileExistsError, FileNotFoundError):
+        raise
+    except OSError:
+        copy_file(src, dst)
 
-def process_audio_file(audio_file, character, audio_emotion, text_emotion, output_path):
+# 分类方式: (文件操作函数, 日志中的动作名称)
+TRANSFER_MODES = {
+    'hardlink': (link_or_copy, '链接'),
+    'copy': (copy_file, '复制'),
+    'move': (shutil.move, '移动'),
+}
+
+def process_audio_file(audio_file, character, audio_emotion, text_emotion, output_path, mode='hardlink'):
     src_path = Path(audio_file)
     
     if not src_path.exists():
@@ -34,32 +41,51 @@ def process_audio_file(audio_file, character, audio_emotion, text_emotion, outpu
     audio_emotion = sanitize_filename(audio_emotion)
     
     emotion_folder = Path(output_path) / character / audio_emotion
-    emotion_folder.mkdir(parents=True, exist_ok=True)
+    # 同一情感文件夹会收到很多文件, 只在第一次真正创建
+    ensure_dir(str(emotion_folder))
 
     audio_name = src_path.name
     new_audio_name = f"【{audio_emotion}】{audio_name}"
     new_audio_name = sanitize_filename(new_audio_name)
     dst_path = emotion_folder / new_audio_name
 
+    transfer, action = TRANSFER_MODES[mode]
     if not dst_path.exists():
         try:
-            shutil.copy(str(src_path), str(dst_path))
-            logging.info(f"已复制 {src_path} 到 {dst_path}")
+            transfer(str(src_path), str(dst_path))
+            logging.info(f"已{action} {src_path} 到 {dst_path}")
         except OSError as e:
-            logging.error(f"复制文件时出错: {e}")
+            logging.error(f"{action}文件时出错: {e}")
     else:
         logging.warning(f"文件已存在: {dst_path}")
 
-async def classify_audio_emotion(log_file, output_path, max_workers=4):
-    log_path = Path(log_file)
-    
-    if not log_path.exists():
-        logging.error(f"日志文件不存在: {log_path}")
+def _process_row(*args):
+    # 在线程中记录异常, 避免单个文件出错时异常无人处理
+    try:
+        process_audio_file(*args)
+    except Exception:
+        logging.exception(f"处理文件时出错: {args[0]}")
+
+def submit_results(executor, results, output_path, mode='hardlink'):
+    """把识别结果(音频路径, 情感, 置信度)直接提交分类, 不经过CSV文件"""
+    # 与识别结果CSV一致, 角色名取音频所在的文件夹名; 此时还没有文本情感
+    return [executor.submit(_process_row, audio_path, os.path.basename(os.path.dirname(audio_path)), audio_emotion, None, output_path, mode)
+            for audio_path, audio_emotion, _ in results]
+
+# 列式格式由pandas/pyarrow读取, 整列一次解析, 不必逐行经过csv模块
+COLUMNAR_READERS = {'.feather': 'read_feather', '.parquet': 'read_parquet'}
+
+def iter_log_rows(log_path):
+    """逐行返回识别结果中的(音频路径, 角色, 音频情感, 文本情感), 按扩展名支持CSV、feather和parquet"""
+    reader_name = COLUMNAR_READERS.get(log_path.suffix.lower())
+    if reader_name is not None:
+        import pandas as pd
+        df = getattr(pd, reader_name)(log_path)
+        characters = df['ParentFolder'] if 'ParentFolder' in df else ["Unknown"] * len(df)
+        text_emotions = df['TextEmotion'].fillna('') if 'TextEmotion' in df else [None] * len(df)
+        yield from zip(df['AudioPath'], characters, df['AudioEmotion'], text_emotions)
         return
-    
-    output_path = Path(output_path)
-    output_path.mkdir(parents=True, exist_ok=True)
-    
+
     with open(log_path, 'r', encoding='utf-8') as f_in:
         reader = csv.reader(f_in, delimiter='|')
         header = next(reader)
@@ -71,18 +97,36 @@ async def classify_audio_emotion(log_file, output_path, max_workers=4):
         audio_path_index = header.index("AudioPath")
         audio_emotion_index = header.index("AudioEmotion")
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for row in reader:
-                audio_path = row[audio_path_index]
-                audio_emotion = row[audio_emotion_index]
-                character = row[3] if len(row) > 3 else "Unknown"
-                text_emotion = row[text_emotion_index] if text_emotion_index is not None else None
-                future = executor.submit(process_audio_file, audio_path, character, audio_emotion, text_emotion, output_path)
-                futures.append(future)
-
-            for future in futures:
-                await asyncio.wrap_future(future)
+        for row in reader:
+            audio_path = row[audio_path_index]
+            audio_emotion = row[audio_emotion_index]
+            character = row[3] if len(row) > 3 else "Unknown"
+            text_emotion = row[text_emotion_index] if text_emotion_index is not None else None
+            yield audio_path, character, audio_emotion, text_emotion
+
+async def classify_audio_emotion(log_file, output_path, max_workers=DEFAULT_IO_WORKERS, mode='hardlink'):
+    log_path = Path(log_file)
+    
+    if not log_path.exists():
+        logging.error(f"日志文件不存在: {log_path}")
+        return
+    
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    forget_dirs()
+    
+    # 边读日志边提交任务, 同时在途的任务数有上限, 内存占用与日志行数无关
+    max_pending = max_workers * 4
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for audio_path, character, audio_emotion, text_emotion in iter_log_rows(log_path):
+            if len(pending) >= max_pending:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            future = executor.submit(_process_row, audio_path, character, audio_emotion, text_emotion, output_path, mode)
+            pending.add(asyncio.wrap_future(future))
+
+        if pending:
+            await asyncio.wait(pending)
 
 if __name__ == "__main__":
     import argparse
@@ -90,8 +134,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='按情感分类音频文件')
     parser.add_argument('--log_file', type=str, required=True, help='日志文件路径')
     parser.add_argument('--output_path', type=str, required=True, help='输出目录路径')
-    parser.add_argument('--max_workers', type=int, default=4, help='最大工作线程数')
+    parser.add_argument('--max_workers', type=int, default=DEFAULT_IO_WORKERS, help='最大工作线程数')
+    parser.add_argument('--mode', choices=list(TRANSFER_MODES), default='hardlink', help='分类方式: 硬链接(不支持时自动复制)、复制或移动, 默认为hardlink')
 
     args = parser.parse_args()
 
-    asyncio.run(classify_audio_emotion(args.log_file, args.output_path, args.max_workers))
\ No newline at end of file
+    asyncio.run(classify_audio_emotion(args.log_file, args.output_path, args.max_workers, args.mode))
\ No newline at end of file
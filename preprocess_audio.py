@@ -1,29 +1,37 @@
 import os
 import logging
 import argparse
-from pydub import AudioSegment
-import glob
-import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from utils import iter_files, copy_file, sanitize_filename, wav_duration, ensure_dir, forget_dirs, DEFAULT_IO_WORKERS
 
 # 设置日志格式
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def sanitize_filename(filename):
-    """清理文件名中的无效字符，并限制长度"""
-    return re.sub(r'[<>:"/\\|?*]', '_', filename.strip(' .'))[:255]
-
-def rename_wav_with_lab(directory):
-    """使用.lab文件中的信息重命名对应的.wav文件"""
-    lab_files = glob.glob(os.path.join(directory, "**", "*.lab"), recursive=True)
+def rename_wav_with_lab(directory, files=None):
+    """使用.lab文件中的信息重命名对应的.wav文件，传入files时直接使用其中的文件而不再遍历目录"""
+    # 一次遍历同时收集.lab和.wav, 配对时查字典即可, 不必为每个文件再stat一次;
+    # 扩展名大小写不限(如clip.WAV配clip.lab), 以小写的主名配对, 重命名时使用实际路径
+    if files is None:
+        files = iter_files(directory, (".wav", ".lab"))
+    lab_files = []
+    wav_by_stem = {}
+    for path in files:
+        stem, suffix = os.path.splitext(path)
+        suffix = suffix.lower()
+        if suffix == ".lab":
+            lab_files.append(path)
+        elif suffix == ".wav":
+            wav_by_stem[stem.lower()] = path
     renamed_count = 0
 
     logging.info(f"找到 {len(lab_files)} 个 .lab 文件。")
 
     for lab_file in lab_files:
-        wav_file = os.path.splitext(lab_file)[0] + ".wav"
+        wav_file = wav_by_stem.get(os.path.splitext(lab_file)[0].lower())
 
-        if not os.path.exists(wav_file):
-            logging.warning(f"找不到对应的WAV文件: {wav_file}")
+        if wav_file is None:
+            logging.warning(f"找不到对应的WAV文件: {os.path.splitext(lab_file)[0]}.wav")
             continue
 
         with open(lab_file, 'r', encoding='utf-8') as f:
@@ -48,8 +56,8 @@ def rename_wav_with_lab(directory):
     logging.info(f"共重命名了 {renamed_count} 个文件")
     return renamed_count
 
-def rename_wav_with_list(list_file, wav_folder):
-    """使用.list文件中的信息重命名.wav文件"""
+def rename_wav_with_list(list_file, wav_folder, files=None):
+    """使用.list文件中的信息重命名.wav文件，传入files时直接使用其中的.wav文件而不再遍历目录"""
     renamed_count = 0
     
     if not os.path.exists(list_file):
@@ -58,6 +66,14 @@ def rename_wav_with_list(list_file, wav_folder):
 
     with open(list_file, 'r', encoding='utf-8') as f:
         lines = f.readlines()
+
+    # 只遍历一次目录建立文件名索引, 避免每行都递归搜索
+    if files is None:
+        files = iter_files(wav_folder, ".wav")
+    wav_index = {}
+    for path in files:
+        if path.lower().endswith(".wav"):
+            wav_index.setdefault(os.path.basename(path), path)
         
     for line in lines:
         parts = line.strip().split('|')
@@ -67,13 +83,12 @@ def rename_wav_with_list(list_file, wav_folder):
 
         wav_name = os.path.basename(parts[0])
         new_name = sanitize_filename(parts[-1])
-        wav_files = glob.glob(os.path.join(wav_folder, "**", wav_name), recursive=True)
+        wav_file = wav_index.get(wav_name)
 
-        if not wav_files:
+        if wav_file is None:
             logging.warning(f"找不到音频文件: {wav_name}")
             continue
 
-        wav_file = wav_files[0]
         new_wav_file = os.path.join(os.path.dirname(wav_file), f"{new_name}.wav")
 
         if new_wav_file != wav_file:
@@ -87,15 +102,44 @@ def rename_wav_with_list(list_file, wav_folder):
     logging.info(f"共重命名了 {renamed_count} 个文件")
     return renamed_count
 
-def filter_audio(src_folder, dst_folder=None, min_duration=3, max_duration=10, copy_parent_folder=False):
-    """根据音频时长过滤文件"""
+def _filter_one(src_path, dst_path, min_duration, max_duration, lab_path=None):
+    """检查单个音频的时长，符合范围则连同.lab文件复制到目标路径，返回复制后的文件列表"""
+    duration = wav_duration(src_path)
+    if not min_duration <= duration <= max_duration:
+        logging.warning(f"跳过: {src_path} (时长: {duration:.2f}秒)")
+        return []
+
+    ensure_dir(os.path.dirname(dst_path))
+    # 原样复制文件字节, 不再经pydub解码后重新编码
+    copy_file(src_path, dst_path)
+    logging.info(f"已复制: {src_path} -> {dst_path}")
+    copied = [dst_path]
+    if lab_path is not None:
+        dst_lab_path = os.path.splitext(dst_path)[0] + ".lab"
+        copy_file(lab_path, dst_lab_path)
+        copied.append(dst_lab_path)
+    return copied
+
+def filter_audio(src_folder, dst_folder=None, min_duration=3, max_duration=10, copy_parent_folder=False, max_workers=DEFAULT_IO_WORKERS):
+    """根据音频时长过滤文件，返回复制到目标位置的文件列表，可直接交给重命名函数使用"""
     if not os.path.exists(src_folder):
         logging.error(f"源文件夹不存在: {src_folder}")
-        return src_folder
-
-    audio_files = glob.glob(os.path.join(src_folder, "**", "*.wav"), recursive=True)
+        return []
+
+    # 在创建进程池之前清空, fork出的子进程不会继承上一轮的目录记录
+    forget_dirs()
+    # 一次遍历同时收集音频和.lab文件, 保留的音频连同.lab一起复制, 之后重命名无需再次遍历
+    # 扩展名大小写不限, 记录.lab文件的实际路径, 不能按小写扩展名重新拼接
+    audio_files, lab_by_stem = [], {}
+    for path in iter_files(src_folder, (".wav", ".lab")):
+        if path.lower().endswith(".lab"):
+            lab_by_stem[os.path.splitext(path)[0]] = path
+        else:
+            audio_files.append(path)
+    lab_paths = [lab_by_stem.get(os.path.splitext(path)[0]) for path in audio_files]
     filtered_folder = dst_folder or src_folder
 
+    dst_paths = []
     for src_path in audio_files:
         dst_path = (os.path.join(os.path.dirname(src_path), f"filtered_{os.path.basename(src_path)}")
                     if dst_folder is None else os.path.join(dst_folder, os.path.relpath(src_path, src_folder)))
@@ -105,17 +149,18 @@ def filter_audio(src_folder, dst_folder=None, min_duration=3, max_duration=10, c
             dst_parent_folder = os.path.join(dst_folder, parent_folder)
             dst_path = os.path.join(dst_parent_folder, os.path.relpath(src_path, src_folder))
 
-        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        dst_paths.append(dst_path)
 
-        duration = AudioSegment.from_wav(src_path).duration_seconds
-        if min_duration <= duration <= max_duration:
-            AudioSegment.from_wav(src_path).export(dst_path, format="wav")
-            logging.info(f"已复制: {src_path} -> {dst_path}")
-        else:
-            logging.warning(f"跳过: {src_path} (时长: {duration:.2f}秒)")
+    # 时长探测和复制互不依赖, 多进程并行以掩盖逐文件的磁盘寻址延迟
+    copied_files = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for copied in executor.map(_filter_one, audio_files, dst_paths, repeat(min_duration),
+                                   repeat(max_duration), lab_paths, chunksize=8):
+            copied_files.extend(copied)
 
-    logging.info(f"过滤后的音频已保存在 {filtered_folder}")
-    return filtered_folder
+    kept = sum(1 for path in copied_files if path.lower().endswith(".wav"))
+    logging.info(f"共保留 {kept}/{len(audio_files)} 个音频, 过滤后的音频已保存在 {filtered_folder}")
+    return copied_files
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='重命名并筛选音频文件')
@@ -124,6 +169,7 @@ if __name__ == "__main__":
     parser.add_argument('-min', '--min_duration', type=float, default=3, help='最小时长(秒), 默认为3秒')
     parser.add_argument('-max', '--max_duration', type=float, default=10, help='最大时长(秒)')
     parser.add_argument('-d', '--disable_filter', action='store_true', help='禁用音频筛选')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_IO_WORKERS, help=f'音频筛选的并行进程数, 默认为{DEFAULT_IO_WORKERS}')
     parser.add_argument('-r', '--rename_method', choices=['lab', 'list'], required=True, help='重命名方式：根据.lab文件或.list文件')
 
     args = parser.parse_args()
@@ -139,7 +185,7 @@ if __name__ == "__main__":
 
     # 然后进行音频筛选
     if not args.disable_filter:
-        filter_audio(args.src_folder, args.dst_folder, args.min_duration, args.max_duration, copy_parent_folder=True)
+        filter_audio(args.src_folder, args.dst_folder, args.min_duration, args.max_duration, copy_parent_folder=True, max_workers=args.workers)
         logging.info(f"音频文件筛选完成，保存在 {args.dst_folder or args.src_folder}")
     else:
         logging.info("音频筛选已禁用")
@@ -2,59 +2,219 @@ import os
 import time
 import logging
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from modelscope.pipelines import pipeline
 from modelscope.utils.constant import Tasks
 import torchaudio
-import glob
+import soundfile as sf
+import numpy as np
 import pandas as pd
 import torch
-import asyncio
+from torch.utils.data import Dataset, DataLoader, Sampler
 import gc
+import re
+import json
+import hashlib
+import functools
+import threading
+from utils import iter_files, wav_duration
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+@functools.lru_cache(maxsize=16)
+def get_resampler(orig_freq, new_freq):
+    # Resample构造时会计算滤波核, 按采样率组合在进程内缓存, 跨数据集和多次运行复用
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+# 重采样后的波形缓存目录, 以点号开头, 遍历音频时会被跳过
+WAVEFORM_CACHE_DIR = ".waveform_cache"
+
+class AudioDataset(Dataset):
+    def __init__(self, audio_paths, target_sample_rate=16000, cache_dir=None):
+        self.audio_paths = audio_paths
+        self.target_sample_rate = target_sample_rate
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            # 缓存只是加速手段, 音频目录只读或磁盘已满时不缓存, 识别照常进行
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError as e:
+                logging.warning(f"无法创建波形缓存目录, 本次不使用缓存: {e}")
+                self.cache_dir = None
+
+    def __len__(self):
+        return len(self.audio_paths)
+
+    def __getitem__(self, index):
+        audio_path = self.audio_paths[index]
+        cache_path = self._cache_path(audio_path)
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                return torch.from_numpy(np.load(cache_path)), audio_path
+            except (OSError, ValueError) as e:
+                logging.warning(f"读取波形缓存失败, 重新解码: {e}")
+
+        # 直接用libsndfile解码为float32, 跳过torchaudio的后端分派; 转置为(通道, 采样点)与torchaudio.load一致
+        samples, sample_rate = sf.read(audio_path, dtype='float32', always_2d=True)
+        waveform = torch.from_numpy(np.ascontiguousarray(samples.T))
+        waveform = self._resample_waveform(waveform, sample_rate)
+        if cache_path is not None:
+            self._save_cache(cache_path, waveform)
+        return waveform, audio_path
+
+    def _save_cache(self, cache_path, waveform):
+        # 先写临时文件再替换, 避免其他worker读到写了一半的缓存
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        try:
+            np.save(tmp_path, waveform.numpy())
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            # 写入失败(只读、磁盘已满)时本worker不再尝试写缓存, 避免每个文件都报错
+            logging.warning(f"写入波形缓存失败, 之后不再写入缓存: {e}")
+            self.cache_dir = None
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _cache_path(self, audio_path):
+        # 以路径、大小和修改时间作为缓存键, 音频被修改或重命名后自动失效
+        if self.cache_dir is None:
+            return None
+        stat = os.stat(audio_path)
+        key = f"{os.path.abspath(audio_path)}|{stat.st_size}|{stat.st_mtime_ns}|{self.target_sample_rate}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".npy")
+
+    def _resample_waveform(self, waveform, sample_rate):
+        # 在DataLoader的worker进程中执行, 不能使用CUDA, 重采样留在CPU上
+        if sample_rate != self.target_sample_rate:
+            waveform = get_resampler(sample_rate, self.target_sample_rate)(waveform)
+        return waveform
+
+class LengthBucketSampler(Sampler):
+    """按音频时长排序后切分批次，使同一批内的音频长度相近"""
+    def __init__(self, lengths, batch_size):
+        order = sorted(range(len(lengths)), key=lengths.__getitem__)
+        self.batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+def collate_audio(batch):
+    # emotion2vec对整句做池化且不支持padding mask, 补零会改变识别结果,
+    # 因此不同长度的音频以列表形式整批送入pipeline
+    waveforms, audio_paths = zip(*batch)
+    return list(waveforms), list(audio_paths)
+
+def audio_worker_init(worker_id):
+    # worker之间已经是并行的, 每个worker内的重采样限制为单线程, 避免多个线程池互相抢占CPU
+    torch.set_num_threads(1)
+
+def find_torch_module(model):
+    """沿.model属性向内查找pipeline包装的torch模型, 找不到时返回None"""
+    # modelscope的pipeline外层是funasr的AutoModel, 真正的nn.Module还在它里面
+    while model is not None and not isinstance(model, torch.nn.Module):
+        model = getattr(model, 'model', None)
+    return model
+
 class EmotionRecognitionPipeline:
-    def __init__(self, model_path="iic/emotion2vec_base_finetuned", model_revision="v2.0.4", device='cuda:0', target_sample_rate=16000):
-        self.device = device
+    def __init__(self, model_path="iic/emotion2vec_base_finetuned", model_revision="v2.0.4", device=None, target_sample_rate=16000, fp16=False, int8=False):
+        self.device = device or ('cuda:0' if torch.cuda.is_available() else 'cpu')
         self.target_sample_rate = target_sample_rate
+        # 半精度只在GPU上启用, int8动态量化只在CPU上启用
+        self.fp16 = fp16 and self.device.startswith('cuda')
+        self.int8 = int8 and not self.device.startswith('cuda')
         self.pipeline = pipeline(
             task=Tasks.emotion_recognition,
             model=model_path,
             model_revision=model_revision,
-            device=device
+            device=self.device
         )
+        module = find_torch_module(self.pipeline.model)
+        if module is None:
+            if self.fp16 or self.int8:
+                logging.warning("未找到可转换精度的模型, 按fp32权重推理")
+        elif self.fp16:
+            # 权重直接以fp16常驻显存, autocast不必在每次前向时重新转换权重
+            module.half()
+        elif self.int8:
+            # 线性层权重量化为int8, 激活在运行时动态量化, 适合CPU推理
+            torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
 
-    async def batch_infer(self, audio_paths):
-        waveforms, sample_rates = zip(*map(torchaudio.load, audio_paths))
-        resampled_waveforms = [self._resample_waveform(waveform, sample_rate) for waveform, sample_rate in zip(waveforms, sample_rates)]
+    def batch_infer(self, waveforms, ready_event=None):
+        if ready_event is None:
+            # DataLoader输出在锁页内存中, 异步拷贝到GPU, 不阻塞主机端
+            waveforms = [waveform.to(self.device, non_blocking=True) for waveform in waveforms]
+        else:
+            # 数据已由CudaPrefetcher在独立流上拷贝, 推理流等待拷贝完成,
+            # 并登记张量在推理流上的使用, 防止显存被提前回收复用
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(ready_event)
+            for waveform in waveforms:
+                waveform.record_stream(stream)
+        # inference_mode跳过autograd记录; autocast让fp32的输入与fp16的权重以fp16执行,
+        # 归一化等对精度敏感的算子仍由autocast保持fp32
+        with torch.inference_mode(), torch.autocast(device_type=self.device.split(':')[0], dtype=torch.float16, enabled=self.fp16):
+            # funasr默认按batch_size=1切分输入逐条调用模型, 这里让整批在一次调用中完成
+            return self.pipeline(waveforms, sample_rate=self.target_sample_rate, batch_size=len(waveforms), granularity="utterance", extract_embedding=False)
 
-        loop = asyncio.get_event_loop()
-        results = await loop.run_in_executor(None, self._batch_pipeline, resampled_waveforms)
-        return results
+_recognizer = None
+_recognizer_key = None
+_recognizer_lock = threading.Lock()
 
-    def _batch_pipeline(self, resampled_waveforms):
-        return self.pipeline(resampled_waveforms, sample_rate=self.target_sample_rate, granularity="utterance", extract_embedding=False)
+def get_recognizer(model_path="iic/emotion2vec_base_finetuned", model_revision="v2.0.4", fp16=False, int8=False):
+    """返回进程内共享的识别模型, WebUI多次点击识别时不再重复加载权重"""
+    global _recognizer, _recognizer_key
+    key = (model_path, model_revision, fp16, int8)
+    with _recognizer_lock:
+        if _recognizer_key != key:
+            # 同一时间只保留一个模型在显存中, 切换模型时先释放旧模型再加载
+            _recognizer = _recognizer_key = None
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            _recognizer = EmotionRecognitionPipeline(model_path=model_path, model_revision=model_revision, fp16=fp16, int8=int8)
+            _recognizer_key = key
+        return _recognizer
 
-    def _resample_waveform(self, waveform, sample_rate):
-        if sample_rate != self.target_sample_rate:
-            resampler = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=self.target_sample_rate).to(self.device)
-            waveform = resampler(waveform.to(self.device))
-        return waveform
+@functools.lru_cache(maxsize=None)
+def short_label(label):
+    # 模型标签形如"生气/angry", 只保留中文部分; 标签只有几种, 每种只拆分一次
+    return label.split('/')[0]
 
 def get_top_emotion_with_confidence(recognition_results):
-    return [(result['labels'][result['scores'].index(max(result['scores']))].split('/')[0], max(result['scores'])) for result in recognition_results]
+    if not recognition_results:
+        return []
+    # 整批得分堆叠为(B, C)矩阵, 一次argmax得到每条音频的最高分
+    scores = np.array([result['scores'] for result in recognition_results])
+    top_indices = scores.argmax(axis=1)
+    top_scores = scores[np.arange(len(scores)), top_indices]
+    return [(short_label(result['labels'][index]), score) for result, index, score in zip(recognition_results, top_indices.tolist(), top_scores.tolist())]
+
+class CudaPrefetcher:
+    """在独立的CUDA流上提前把下一批音频拷贝到GPU，与当前批的推理重叠"""
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
 
-async def process_batch(batch_audio_paths, recognizer):
-    top_emotions_with_confidence = get_top_emotion_with_confidence(await recognizer.batch_infer(batch_audio_paths))
-    return [(audio_path, *top_emotion_confidence) for audio_path, top_emotion_confidence in zip(batch_audio_paths, top_emotions_with_confidence)]
+    def __iter__(self):
+        for waveforms, audio_paths in self.loader:
+            with torch.cuda.stream(self.stream):
+                waveforms = [waveform.to(self.device, non_blocking=True) for waveform in waveforms]
+                ready_event = torch.cuda.Event()
+                ready_event.record(self.stream)
+            yield waveforms, audio_paths, ready_event
 
-def audio_path_generator(folder_path):
-    audio_paths = glob.glob(os.path.join(folder_path, '**', '*.wav'), recursive=True)
-    for audio_path in audio_paths:
-        yield audio_path
+def process_batch(waveforms, audio_paths, recognizer, ready_event=None):
+    top_emotions_with_confidence = get_top_emotion_with_confidence(recognizer.batch_infer(waveforms, ready_event))
+    return [(audio_path, *top_emotion_confidence) for audio_path, top_emotion_confidence in zip(audio_paths, top_emotions_with_confidence)]
 
-async def process_audio_files(folder_path, recognizer, batch_size=64, max_workers=4):
+def process_audio_files(folder_path, recognizer, batch_size=64, max_workers=4, cache_dir=None, on_batch=None):
+    """识别目录中的全部音频; 传入on_batch时每批结果一产生就交给它, 下游无需等待整个目录识别完"""
     if not os.path.exists(folder_path):
         logging.error(f"目录不存在：{folder_path}")
         return None
@@ -62,74 +222,155 @@ async def process_audio_files(folder_path, recognizer, batch_size=64, max_worker
     results = []
     start_time = time.time()
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        batch = []
-        for audio_path in audio_path_generator(folder_path):
-            batch.append(audio_path)
-            if len(batch) == batch_size:
-                results.extend(await process_batch(batch, recognizer))
-                batch = []
+    # 解码和重采样由DataLoader的worker进程并行完成, 每批音频只调用一次模型
+    audio_paths = list(iter_files(folder_path, '.wav'))
+    dataset = AudioDataset(audio_paths, recognizer.target_sample_rate, cache_dir)
+    # 长度相近的音频分在同一批, 各批张量尺寸接近, 显存块可以在批次间复用
+    sampler = LengthBucketSampler([wav_duration(path) for path in audio_paths], batch_size)
+    pin_memory = recognizer.device.startswith('cuda')
+    # 文件很少时启动worker进程的开销比解码本身还大, worker数不超过批数和CPU核数
+    num_workers = min(max_workers, os.cpu_count() or 1, len(sampler))
+    loader_options = {'worker_init_fn': audio_worker_init, 'prefetch_factor': 4} if num_workers > 0 else {}
+    loader = DataLoader(dataset, batch_sampler=sampler, num_workers=num_workers, collate_fn=collate_audio, pin_memory=pin_memory, **loader_options)
+
+    if pin_memory:
+        batches = CudaPrefetcher(loader, recognizer.device)
+    else:
+        batches = ((waveforms, batch_paths, None) for waveforms, batch_paths in loader)
+
+    def collect(batch_results):
+        results.extend(batch_results)
+        if on_batch is not None:
+            on_batch(batch_results)
+
+    # 推理在单独的线程中进行, 上一批推理时主线程继续从DataLoader取下一批并发起拷贝
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for waveforms, batch_paths, ready_event in batches:
+            if pending is not None:
+                collect(pending.result())
                 gc.collect()  # 主动调用垃圾回收
+            pending = executor.submit(process_batch, waveforms, batch_paths, recognizer, ready_event)
+        if pending is not None:
+            collect(pending.result())
 
-        if batch:
-            results.extend(await process_batch(batch, recognizer))
+    # 按时长分批打乱了顺序, 输出时恢复为目录遍历顺序
+    position = {path: index for index, path in enumerate(audio_paths)}
+    results.sort(key=lambda result: position[result[0]])
 
     logging.info(f"Processed files in {folder_path}, total time: {time.time() - start_time:.2f} seconds")
     return results
 
+def results_to_dataframe(audio_emotion_results):
+    df = pd.DataFrame(audio_emotion_results, columns=['AudioPath', 'AudioEmotion', 'Confidence'])
+    # 列表推导直接调用os.path, 省去apply逐行构造Series的开销
+    df['ParentFolder'] = [os.path.basename(os.path.dirname(path)) for path in df['AudioPath']]
+    return df
+
+TEXT_EMOTION_CACHE_FILE = "text_emotion_cache.json"
+
+# 文本分类模型的标签映射到与音频情感一致的名称, 模块加载时构建一次
+TEXT_EMOTION_MAPPING = {
+    '恐惧': '恐惧',
+    '愤怒': '生气',
+    '厌恶': '厌恶',
+    '喜好': '开心',
+    '悲伤': '难过',
+    '高兴': '开心',
+    '惊讶': '吃惊'
+}
+
+_CJK_RE = re.compile(r'[\u4e00-\u9fff]+')
+
 def contains_chinese(text):
-    return any('\u4e00' <= char <= '\u9fff' for char in text)
-
-def process_text_emotion(df, text_classifier):
-    emotion_mapping = {
-        '恐惧': '恐惧',
-        '愤怒': '生气', 
-        '厌恶': '厌恶',
-        '喜好': '开心',
-        '悲伤': '难过',
-        '高兴': '开心',
-        '惊讶': '吃惊'
-    }
-
-    def get_chinese_text(text):
-        return ''.join(char for char in text if contains_chinese(char))
-
-    texts = df['AudioPath'].apply(lambda x: os.path.splitext(os.path.basename(x))[0]).tolist()
-
-    mapped_emotions = []
-    for text in texts:
-        if not contains_chinese(text):
-            mapped_emotions.append('')
-        else:
-            chinese_text = get_chinese_text(text)
-            result = text_classifier([chinese_text])[0]
-            scores = result['scores']
-            labels = result['labels'] 
-            max_index = scores.index(max(scores))
-            original_emotion = labels[max_index]
-            mapped_emotion = emotion_mapping.get(original_emotion, original_emotion)
-            mapped_emotions.append(mapped_emotion)
-
-    df['TextEmotion'] = mapped_emotions
+    return _CJK_RE.search(text) is not None
+
+def get_chinese_text(text):
+    return ''.join(_CJK_RE.findall(text))
+
+def load_text_emotion_cache(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"读取文本情感缓存失败, 将重新推理: {e}")
+        return {}
+
+def save_text_emotion_cache(cache_file, cache):
+    if cache_file is None:
+        return
+    # 先写临时文件再替换, 中途中断也不会留下损坏的缓存
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_file, cache_file)
+
+@functools.lru_cache(maxsize=4)
+def _get_pipeline(task, model_path, revision):
+    """按(任务, 模型, 版本)缓存modelscope pipeline, 同一模型只加载一次"""
+    return pipeline(task, model_path, model_revision=revision)
+
+def process_text_emotion(df, text_classifier, batch_size=64, cache_file=None):
+    texts = pd.Series([os.path.splitext(os.path.basename(path))[0] for path in df['AudioPath']], index=df.index)
+    # 一次正则扫描提取全部中文片段, 不含中文的文件名得到空字符串
+    chinese_texts = texts.str.findall(_CJK_RE).str.join('')
+    has_chinese = chinese_texts != ''
+
+    text_emotions = pd.Series('', index=df.index, dtype=object)
+    if has_chinese.any():
+        # 分类结果只取决于中文文本, 已缓存或重复的文本不再送入分类器
+        cache = load_text_emotion_cache(cache_file)
+        misses = [text for text in chinese_texts[has_chinese].unique() if text not in cache]
+        if misses:
+            # 同一批文本会补齐到最长的一条, 按长度排序后分批可减少补齐的token
+            misses.sort(key=len)
+            results = text_classifier(misses, batch_size=batch_size)
+            scores = np.array([result['scores'] for result in results])
+            labels = np.array([result['labels'] for result in results])
+            cache.update(zip(misses, labels[np.arange(len(results)), scores.argmax(axis=1)].tolist()))
+            save_text_emotion_cache(cache_file, cache)
+        logging.info(f"文本情感: {has_chinese.sum()} 条, 新推理 {len(misses)} 条")
+
+        top_emotions = chinese_texts[has_chinese].map(cache)
+        text_emotions.loc[has_chinese] = top_emotions.map(TEXT_EMOTION_MAPPING).fillna(top_emotions)
+
+    df['TextEmotion'] = text_emotions
     return df
 
-async def main(args):
-    emotion_recognizer = EmotionRecognitionPipeline(model_revision=args.model_revision)
-    audio_emotion_results = await process_audio_files(args.folder_path, emotion_recognizer, args.batch_size, args.max_workers)
+def save_results(df, output_file):
+    """按扩展名保存识别结果: .feather/.parquet保存为列式格式(需要pyarrow), 其他保存为以|分隔的CSV"""
+    suffix = os.path.splitext(output_file)[1].lower()
+    if suffix == '.feather':
+        df.to_feather(output_file)
+    elif suffix == '.parquet':
+        df.to_parquet(output_file, index=False)
+    else:
+        df.to_csv(output_file, sep='|', index=False, encoding='utf-8')
+    logging.info(f"Results saved to {output_file}")
+
+def main(args, on_batch=None):
+    emotion_recognizer = get_recognizer(model_revision=args.model_revision, fp16=args.fp16, int8=args.int8)
+    cache_dir = None if args.no_cache else os.path.join(args.folder_path, WAVEFORM_CACHE_DIR)
+    audio_emotion_results = process_audio_files(args.folder_path, emotion_recognizer, args.batch_size, args.max_workers, cache_dir, on_batch)
 
     if audio_emotion_results is None:
         return
 
-    df = pd.DataFrame(audio_emotion_results, columns=['AudioPath', 'AudioEmotion', 'Confidence'])
-    df['ParentFolder'] = df['AudioPath'].apply(lambda x: os.path.basename(os.path.dirname(x)))
+    df = results_to_dataframe(audio_emotion_results)
 
     if not args.disable_text_emotion:
-        text_classifier = pipeline(Tasks.text_classification, 'model/structbert_emotion', model_revision='v1.0.0')
-        df = process_text_emotion(df, text_classifier)
+        text_classifier = _get_pipeline(Tasks.text_classification, 'model/structbert_emotion', 'v1.0.0')
+        # 没有输出文件时不读写文本情感缓存
+        cache_file = os.path.join(os.path.dirname(os.path.abspath(args.output_file)), TEXT_EMOTION_CACHE_FILE) if args.output_file else None
+        df = process_text_emotion(df, text_classifier, args.batch_size, cache_file)
 
+    # 结果始终在内存中的DataFrame里返回, 只有指定了输出文件时才落盘
     output_file = args.output_file
-    df.to_csv(output_file, sep='|', index=False, encoding='utf-8')
-    logging.info(f"Results saved to {output_file}")
+    if output_file:
+        save_results(df, output_file)
+    return df
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='识别音频文件中的情感')
@@ -137,7 +378,10 @@ if __name__ == "__main__":
     parser.add_argument('--output_file', type=str, required=True, help='输出文件的路径')
     parser.add_argument('--model_revision', type=str, default="v2.0.4", help='情感识别模型的修订版本')
     parser.add_argument('--batch_size', type=int, default=64, help='推理的批量大小')
-    parser.add_argument('--max_workers', type=int, default=4, help='并行处理的最大工作线程数')
+    parser.add_argument('--max_workers', type=int, default=4, help='并行加载音频的worker进程数')
+    parser.add_argument('--fp16', action='store_true', help='在GPU上以半精度推理')
+    parser.add_argument('--int8', action='store_true', help='在CPU上以int8动态量化推理')
+    parser.add_argument('--no_cache', action='store_true', help='不读写重采样后的波形缓存')
     parser.add_argument('--disable_text_emotion', action='store_true', help='是否禁用文本情感分类')
     args = parser.parse_args()
-    asyncio.run(main(args))
+    main(args)
@@ -0,0 +1,199 @@
+import os
+import re
+import struct
+import errno
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# 筛选和分类都以读取文件头、复制/链接文件为主, 大部分时间在等待IO, 并行数可以远高于CPU核数
+DEFAULT_IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+def sanitize_filename(filename):
+    """清理文件名中的无效字符，并限制长度"""
+    # 替换无效字符为下划线, 再去除前后的空格和点号
+    return re.sub(r'[<>:"/\\|?*]', '_', filename).strip(' .')[:255]
+
+# 每个块对齐单元正好是一帧的编码: PCM、IEEE float、A-law、µ-law; ADPCM等分块压缩编码不在其中
+_FIXED_FRAME_FORMATS = {0x0001, 0x0003, 0x0006, 0x0007}
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# WAVE_FORMAT_EXTENSIBLE的SubFormat GUID中, 前两个字节之后的固定部分
+_KSDATAFORMAT_SUFFIX = b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+def _fixed_frame_format(fmt):
+    """判断fmt块描述的编码能否直接由data长度和块对齐计算帧数"""
+    format_tag = struct.unpack('<H', fmt[:2])[0]
+    if format_tag == _WAVE_FORMAT_EXTENSIBLE:
+        # 实际编码记录在SubFormat中, 只接受PCM和IEEE float
+        if len(fmt) < 40 or fmt[26:40] != _KSDATAFORMAT_SUFFIX:
+            return False
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+        return format_tag in (0x0001, 0x0003)
+    return format_tag in _FIXED_FRAME_FORMATS
+
+def wav_duration(path):
+    """只读取WAV文件头计算时长(秒)，不解码音频数据"""
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        riff = f.read(12)
+        if len(riff) == 12 and riff[:4] == b'RIFF' and riff[8:] == b'WAVE':
+            # 按块解析, 只需要fmt块中的编码、采样率、块对齐和data块的长度
+            sample_rate = block_align = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == b'fmt ':
+                    fmt = f.read(chunk_size)
+                    # ADPCM等压缩编码一个块对齐单元包含多帧, 不能按文件头计算, 交给libsndfile
+                    if len(fmt) < 14 or not _fixed_frame_format(fmt):
+                        break
+                    _, _, sample_rate, _, block_align = struct.unpack('<HHIIH', fmt[:14])
+                    f.seek(chunk_size & 1, os.SEEK_CUR)
+                elif chunk_id == b'data':
+                    if sample_rate and block_align:
+                        # 流式写入的文件可能没有回填data长度, 截断的文件长度也会偏大, 以实际剩余字节为准
+                        data_size = min(chunk_size, file_size - f.tell())
+                        return data_size // block_align / sample_rate
+                    break
+                else:
+                    # 跳过LIST等其他块, 块长度为奇数时后面有一个填充字节
+                    f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+    # 文件头无法解析(如RF64)或编码不是逐帧定长的, 由libsndfile读取文件头得到帧数, 同样不解码
+    try:
+        import soundfile as sf
+        info = sf.info(path)
+        return info.frames / info.samplerate
+    except (ImportError, RuntimeError):
+        # libsndfile也无法识别时才退回pydub完整解码
+        pass
+    from pydub import AudioSegment
+    return AudioSegment.from_wav(path).duration_seconds
+
+def iter_files(root, suffix=".wav"):
+    """用os.scandir递归遍历目录，返回指定扩展名(可为元组)的文件路径"""
+    suffix = suffix.lower() if isinstance(suffix, str) else tuple(s.lower() for s in suffix)
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                # 与glob保持一致, 跳过隐藏文件和隐藏目录
+                if entry.name.startswith('.'):
+                    continue
+                # DirEntry的类型信息来自目录读取本身, 无需额外stat
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(suffix):
+                    yield entry.path
+
+# 本进程中已确认存在的目录; 每轮处理开始时和remove_tree删除目录时清空,
+# 防止运行期间被外部删除的目录仍被当作存在
+_known_dirs = set()
+
+def forget_dirs():
+    """清空已确认存在的目录记录, 下次ensure_dir时重新检查"""
+    _known_dirs.clear()
+
+def ensure_dir(path):
+    """创建目录(含父目录), 已确认存在过的目录直接返回, 不再发起系统调用"""
+    if path in _known_dirs:
+        return
+    os.makedirs(path, exist_ok=True)
+    _known_dirs.add(path)
+
+def count_entries(path, limit):
+    """统计目录中的条目数, 数到limit即停止, 不需要读取完整的目录列表"""
+    count = 0
+    with os.scandir(path) as it:
+        for _ in it:
+            count += 1
+            if count >= limit:
+                break
+    return count
+
+# copy_file_range不可用时的错误码: 内核不支持、跨文件系统(旧内核)或文件系统不支持
+_COPY_FILE_RANGE_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+def _copy_file_range(src, dst):
+    """尝试用os.copy_file_range在内核中复制文件, 不支持时返回False"""
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    # 部分文件系统(ecryptfs、某些FUSE/overlay)并不真正支持该调用, 一开始就返回0,
+                    # 此时交给shutil.copyfile; 复制到一半返回0说明源文件被截断, 不能当作复制成功
+                    if remaining == size:
+                        return False
+                    raise OSError(errno.EIO, f"复制中途源文件长度发生变化: {src}")
+                remaining -= copied
+        except OSError as e:
+            if e.errno not in _COPY_FILE_RANGE_UNSUPPORTED:
+                raise
+            return False
+    return True
+
+def copy_file(src, dst):
+    """复制文件内容及修改时间等元数据, 语义同shutil.copy2"""
+    # 支持reflink的文件系统(btrfs、XFS)上copy_file_range只复制元数据;
+    # 其他平台退回shutil.copyfile, 它会使用sendfile等系统级快速复制
+    if not _copy_file_range(src, dst):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+def _try_unlink(path):
+    """删除文件, 失败时返回出错的路径, 成功或文件已不存在时返回None"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return f"{path}: {e}"
+    return None
+
+def remove_tree(path, max_workers=16):
+    """删除整个目录树, 文件由线程池并行删除; 与shutil.rmtree(ignore_errors=True)一样遇错继续,
+    返回未能删除的条目列表, 目录不存在时返回空列表"""
+    errors = []
+    dirs = []
+    files = []
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    # 不跟随目录的符号链接, 与shutil.rmtree一致, 只删除链接本身
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        files.append(entry.path)
+        except FileNotFoundError:
+            continue
+        except NotADirectoryError:
+            files.append(current)
+            continue
+        except OSError as e:
+            errors.append(f"{current}: {e}")
+            continue
+        dirs.append(current)
+    # unlink基本都在等待文件系统, 执行时释放GIL, 多线程可以同时进行
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors.extend(error for error in executor.map(_try_unlink, files) if error is not None)
+    # 子目录在父目录之后入栈, 倒序删除即可保证先删子目录
+    for directory in reversed(dirs):
+        try:
+            os.rmdir(directory)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # 目录中有删不掉的文件(被占用、只读)时目录本身也删不掉, 只报告一次文件即可
+            if not any(error.startswith(directory + os.sep) for error in errors):
+                errors.append(f"{directory}: {e}")
+    # 记录的目录可能就在被删除的树中, 全部作废, 下次ensure_dir时重新创建;
+    # 必须在目录全部删除之后清空, 否则删除期间并发记录的目录会被删掉却仍被当作存在
+    forget_dirs()
+    return errors
@@ -4,15 +4,17 @@ import logging
 import gradio as gr
 import sys
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 
 from preprocess_audio import filter_audio, rename_wav_with_lab, rename_wav_with_list
-from recognize import main as recognize_main
-from recognizev2 import main as recognizev2_main
-from classify import classify_audio_emotion
+from classify import classify_audio_emotion, submit_results
+from utils import DEFAULT_IO_WORKERS, count_entries, iter_files, remove_tree, ensure_dir, forget_dirs
 import shutil
+import hashlib
 
 # 配置logging模块来关闭Gradio的输出
 logging.getLogger("gradio").setLevel(logging.ERROR)
@@ -25,36 +27,68 @@ INPUT_FOLDER = "input"
 PREPROCESS_OUTPUT_FOLDER = "referenceaudio"
 CSV_OUTPUT_FOLDER = "csv_opt"
 CLASSIFY_OUTPUT_FOLDER = "output"
+# 识别结果的默认保存路径, 一键推理、识别和分类共用
+DEFAULT_RECOG_CSV = os.path.join(CSV_OUTPUT_FOLDER, "recognition_result.csv")
 
 MIN_DURATION = 3
 MAX_DURATION = 10
 
 BATCH_SIZE = 50
-MAX_WORKERS = 4
 MODEL_REVISION = "v2.0.4"
+# 识别结果缓存目录, 位于CSV输出目录下
+RECOGNITION_CACHE_DIR = ".cache"
+FP16 = False
+INT8 = False
+DISABLE_TEXT_EMOTION = True
+
+def _auto_workers(stage):
+    """按各阶段的瓶颈选择默认工作进程/线程数"""
+    cpu = os.cpu_count() or 1
+    if stage in ("preprocess", "classify"):
+        # 读取文件头、复制/链接文件都在等待IO, 与命令行使用同一个默认值
+        return DEFAULT_IO_WORKERS
+    if stage == "recognize":
+        # 只有识别阶段需要检测GPU, torch导入较慢, 其他阶段不导入
+        import torch
+        # 解码worker只负责给模型供数据; GPU推理时几个worker就足够,
+        # CPU推理时要给模型本身的计算线程留出核心
+        return min(4, cpu) if torch.cuda.is_available() else max(1, min(4, cpu // 2))
+    raise ValueError(f"未知阶段: {stage}")
+
+def _warm_up():
+    # 识别模块会导入torch、modelscope等重量级依赖, 放到后台线程中预先导入并加载默认模型,
+    # 界面不必等待它们即可启动, 首次点击识别时也不用再等
+    import recognizev2  # noqa: F401
+    from recognize import get_recognizer
+    try:
+        get_recognizer(model_revision=MODEL_REVISION, fp16=FP16, int8=INT8)
+    except Exception:
+        # 预加载失败不影响界面, 点击识别时会重新加载并报告错误
+        logging.exception("预加载情感识别模型失败")
 
 def create_folders(folders):
     for folder in folders:
-        os.makedirs(folder, exist_ok=True)
-
-async def preprocess_and_rename_audio(input_folder, output_folder, min_duration, max_duration, disable_filter, rename_method, list_file=None):
-    src_items = len(os.listdir(input_folder))
-    copy_parent_folder = src_items > 5
+        ensure_dir(folder)
 
+def preprocess_and_rename_audio(input_folder, output_folder, min_duration, max_duration, disable_filter, rename_method, list_file=None):
+    # 过滤时已经遍历过的文件列表交给重命名函数复用, 禁用过滤时由其自行遍历
+    files = None
     if disable_filter:
         filter_result = "跳过音频过滤步骤。"
         audio_folder = input_folder
     else:
-        filter_audio(input_folder, output_folder, min_duration, max_duration, copy_parent_folder=copy_parent_folder)
+        # 只关心条目数是否超过5个, 数到第6个即可停止; 禁用过滤时用不到, 不必读取目录
+        copy_parent_folder = count_entries(input_folder, 6) > 5
+        files = filter_audio(input_folder, output_folder, min_duration, max_duration, copy_parent_folder=copy_parent_folder, max_workers=_auto_workers("preprocess"))
         filter_result = f"音频过滤完成,结果保存在 {output_folder} 文件夹中。"
         audio_folder = output_folder
 
     if rename_method == "lab":
-        renamed_files = rename_wav_with_lab(audio_folder)
+        renamed_files = rename_wav_with_lab(audio_folder, files)
         rename_result = f"根据 .lab 文件重命名音频完成,共重命名 {renamed_files} 个文件。"
     elif rename_method == "list":
         if list_file:
-            renamed_files = rename_wav_with_list(list_file, audio_folder)
+            renamed_files = rename_wav_with_list(list_file, audio_folder, files)
             rename_result = f"根据 .list 文件重命名音频完成,共重命名 {renamed_files} 个文件。"
         else:
             rename_result = "请提供 .list 文件路径。"
@@ -63,25 +97,57 @@ async def preprocess_and_rename_audio(input_folder, output_folder, min_duration,
 
     return f"{filter_result}\n{rename_result}", audio_folder
 
-async def recognize_audio_emotions(audio_folder, batch_size, max_workers, output_file, model_name):
+def _recognition_cache_path(audio_folder, model_name, output_file):
+    """根据音频文件列表、大小、修改时间和所用模型及推理设置计算识别结果的缓存路径"""
+    # 精度和是否做文本情感都会改变结果, 一并计入缓存键
+    digest = hashlib.sha1(f"{model_name}|{MODEL_REVISION}|fp16={FP16}|int8={INT8}|text={not DISABLE_TEXT_EMOTION}".encode('utf-8'))
+    for path in sorted(iter_files(audio_folder, '.wav')):
+        stat = os.stat(path)
+        digest.update(f"|{path}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8'))
+    # 缓存文件与输出文件格式相同, 命中时直接复制
+    return os.path.join(CSV_OUTPUT_FOLDER, RECOGNITION_CACHE_DIR, digest.hexdigest() + os.path.splitext(output_file)[1])
+
+def recognize_audio_emotions(audio_folder, batch_size, max_workers, output_file, model_name, on_batch=None):
+    from recognize import main as recognize_main
+    from recognizev2 import main as recognizev2_main
+
+    # 工作线程数为0时在这里才检测GPU选择默认值, 构建界面时不必导入torch
+    max_workers = int(max_workers) or _auto_workers("recognize")
+
+    # 音频和模型都没有变化时直接复用上次的识别结果, 不再重新推理
+    cache_path = _recognition_cache_path(audio_folder, model_name, output_file) if os.path.isdir(audio_folder) else None
+    if cache_path and os.path.exists(cache_path):
+        shutil.copyfile(cache_path, output_file)
+        return f"音频未发生变化, 已复用缓存的识别结果, 结果保存在 {output_file} 文件中。"
+
     if model_name == 'emotion2vec':
         recognize_args = argparse.Namespace(
             folder_path=audio_folder,
             output_file=output_file,
             batch_size=batch_size,
             max_workers=max_workers,
-            disable_text_emotion=True,
-            model_revision=MODEL_REVISION
+            disable_text_emotion=DISABLE_TEXT_EMOTION,
+            model_revision=MODEL_REVISION,
+            fp16=FP16,
+            int8=INT8,
+            no_cache=False
         )
-        await recognize_main(recognize_args)
+        recognize_main(recognize_args, on_batch)
     else:
         recognizev2_args = argparse.Namespace(
             folder_path=audio_folder,
             output_file=output_file,
             batch_size=batch_size,
-            max_workers=max_workers
+            max_workers=max_workers,
+            fp16=FP16,
+            int8=INT8,
+            no_cache=False
         )
-        await recognizev2_main(recognizev2_args)
+        recognizev2_main(recognizev2_args, on_batch)
+
+    if cache_path and os.path.exists(output_file):
+        ensure_dir(os.path.dirname(cache_path))
+        shutil.copyfile(output_file, cache_path)
 
     return f"音频情感识别完成,结果保存在 {output_file} 文件中。"
 
@@ -90,21 +156,44 @@ async def classify_audio_emotions(log_file, max_workers, output_folder):
     return f"音频情感分类完成,结果保存在 {output_folder} 文件夹中。"
 
 async def run_end_to_end_pipeline(input_folder, min_duration, max_duration, batch_size, max_workers, disable_filter, rename_method, model_name, list_file=None):
-    preprocess_result, audio_folder = await preprocess_and_rename_audio(input_folder, PREPROCESS_OUTPUT_FOLDER, min_duration, max_duration, disable_filter, rename_method, list_file)
-    output_file = os.path.join(CSV_OUTPUT_FOLDER, "recognition_result.csv")
-    recognize_result = await recognize_audio_emotions(audio_folder, batch_size, max_workers, output_file, model_name)
-    classify_result = await classify_audio_emotions(output_file, max_workers, CLASSIFY_OUTPUT_FOLDER)
+    # 预处理同样是阻塞调用, 放到线程中执行, 避免过滤和重命名期间事件循环无法响应其他请求
+    preprocess_result, audio_folder = await asyncio.to_thread(preprocess_and_rename_audio, input_folder, PREPROCESS_OUTPUT_FOLDER, min_duration, max_duration, disable_filter, rename_method, list_file)
+    output_file = DEFAULT_RECOG_CSV
+    # 工作线程数为0时, 识别和分类分别使用各自阶段的默认值
+    recognize_workers = int(max_workers) or _auto_workers("recognize")
+    classify_workers = int(max_workers) or _auto_workers("classify")
+    forget_dirs()
+    # 识别完一批就立即提交这批的分类任务, 分类与后续批次的识别同时进行
+    with ThreadPoolExecutor(max_workers=classify_workers) as executor:
+        futures = []
+        def on_batch(results):
+            futures.extend(submit_results(executor, results, CLASSIFY_OUTPUT_FOLDER))
+        # 识别是阻塞调用, 放到线程中执行, 不占用事件循环
+        recognize_result = await asyncio.to_thread(recognize_audio_emotions, audio_folder, batch_size, recognize_workers, output_file, model_name, on_batch)
+        if futures:
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+    if futures:
+        classify_result = f"音频情感分类完成,结果保存在 {CLASSIFY_OUTPUT_FOLDER} 文件夹中。"
+    else:
+        # 复用了缓存的识别结果时没有逐批输出, 从结果CSV分类
+        classify_result = await classify_audio_emotions(output_file, classify_workers, CLASSIFY_OUTPUT_FOLDER)
     return f"{preprocess_result}\n{recognize_result}\n{classify_result}"
 
 def reset_folders():
     folders = [CSV_OUTPUT_FOLDER, CLASSIFY_OUTPUT_FOLDER, PREPROCESS_OUTPUT_FOLDER]
+    errors = []
     for folder in folders:
-        shutil.rmtree(folder, ignore_errors=True)
-        os.makedirs(folder)
+        # 被占用或只读的文件跳过, 继续删除其余内容, 最后统一报告
+        errors.extend(remove_tree(folder))
+        os.makedirs(folder, exist_ok=True)
+    if errors:
+        logging.warning("以下条目未能删除:\n" + "\n".join(errors))
+        return f"{', '.join(folders)} 文件夹已重置, 但有 {len(errors)} 个条目未能删除(可能被占用或只读):\n" + "\n".join(errors[:10])
     return f"{', '.join(folders)} 文件夹已重置。"
 
 async def launch_ui():
     create_folders([INPUT_FOLDER, PREPROCESS_OUTPUT_FOLDER, CSV_OUTPUT_FOLDER, CLASSIFY_OUTPUT_FOLDER])
+    threading.Thread(target=_warm_up, daemon=True).start()
 
     with gr.Blocks(theme=gr.themes.Base(
             primary_hue="teal",  
@@ -127,7 +216,7 @@ async def launch_ui():
                     one_click_disable_filter = gr.Checkbox(value=False, label="禁用参考音频筛选")
                 with gr.Column():
                     one_click_batch_size = gr.Slider(1, 100, value=BATCH_SIZE, step=1, label="批量大小")
-                    one_click_max_workers = gr.Slider(1, 16, value=MAX_WORKERS, step=1, label="最大工作线程数") 
+                    one_click_max_workers = gr.Slider(0, 16, value=0, step=1, label="最大工作线程数(0为按阶段自动选择)")
 
             with gr.Row():
                 one_click_rename_method = gr.Radio(["lab", "list"], label="音频重命名方式", value="lab")
@@ -148,7 +237,7 @@ async def launch_ui():
             async def run_pipeline(input_folder, min_duration, max_duration, batch_size, max_workers, disable_filter, rename_method, model_name, list_file):
                 return await run_end_to_end_pipeline(input_folder, min_duration, max_duration, batch_size, max_workers, disable_filter, rename_method, model_name, list_file)
 
-            one_click_button.click(run_pipeline, inputs=[one_click_input_folder, one_click_min_duration, one_click_max_duration, one_click_batch_size, one_click_max_workers, one_click_disable_filter, one_click_rename_method, one_click_model_name, one_click_list_file], outputs=one_click_result)
+            one_click_button.click(run_pipeline, inputs=[one_click_input_folder, one_click_min_duration, one_click_max_duration, one_click_batch_size, one_click_max_workers, one_click_disable_filter, one_click_rename_method, one_click_model_name, one_click_list_file], outputs=one_click_result, concurrency_limit=1, concurrency_id="gpu")
             one_click_reset_button.click(reset_folders, [], one_click_result)
 
         with gr.Tab("音频预处理"):
@@ -178,30 +267,33 @@ async def launch_ui():
         with gr.Tab("音频情感识别"):    
             with gr.Row():
                 recognize_folder = gr.Textbox(value=PREPROCESS_OUTPUT_FOLDER, label="音频文件夹")
-                recognize_output_file = gr.Textbox(value=os.path.join(CSV_OUTPUT_FOLDER, "recognition_result.csv"), label="输出文件路径")
+                recognize_output_file = gr.Textbox(value=DEFAULT_RECOG_CSV, label="输出文件路径")
 
             with gr.Row():
                 recognize_batch_size = gr.Slider(1, 100, value=BATCH_SIZE, step=1, label="批量大小")
-                recognize_max_workers = gr.Slider(1, 16, value=MAX_WORKERS, step=1, label="最大工作线程数")
+                recognize_max_workers = gr.Slider(0, 16, value=0, step=1, label="最大工作线程数(0为自动选择)")
                 recognize_model_name = gr.Radio(["emotion2vec", "emotion2vec+"], label="情感识别模型", value="emotion2vec")
                 
             recognize_button = gr.Button("开始识别", variant="primary")
             recognize_result = gr.Textbox(label="识别结果", lines=3)
 
-            recognize_button.click(recognize_audio_emotions, [recognize_folder, recognize_batch_size, recognize_max_workers, recognize_output_file, recognize_model_name], recognize_result)
+            recognize_button.click(recognize_audio_emotions, [recognize_folder, recognize_batch_size, recognize_max_workers, recognize_output_file, recognize_model_name], recognize_result, concurrency_limit=1, concurrency_id="gpu")
 
         with gr.Tab("音频情感分类"):
             with gr.Row():
-                classify_log_file = gr.Textbox(value=os.path.join(CSV_OUTPUT_FOLDER, "recognition_result.csv"), label="日志文件")
+                classify_log_file = gr.Textbox(value=DEFAULT_RECOG_CSV, label="日志文件")
                 classify_output = gr.Textbox(value=CLASSIFY_OUTPUT_FOLDER, label="输出文件夹")
 
-            classify_max_workers = gr.Slider(1, 16, value=MAX_WORKERS, step=1, label="最大工作线程数")
+            classify_max_workers = gr.Slider(1, 32, value=_auto_workers("classify"), step=1, label="最大工作线程数")
 
             classify_button = gr.Button("开始分类", variant="primary")  
             classify_result = gr.Textbox(label="分类结果", lines=3)
 
             classify_button.click(classify_audio_emotions, [classify_log_file, classify_max_workers, classify_output], classify_result)
         
+    # 预处理和分类以IO为主, 可以同时处理多个请求; 一键推理和识别共用同一队列(gpu),
+    # 同一时间只有一个任务占用显卡, 其余请求排队等待
+    demo.queue(default_concurrency_limit=4, max_size=32)
     await demo.launch(inbrowser=True, server_name="0.0.0.0", server_port=9975, max_threads=100, share=False)
 
 if __name__ == "__main__":